@@ -1,46 +1,352 @@
 import streamlit as st
 import pandas as pd
-import pytz
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+import io
+import re
+import httpx
 import time
+import threading
 from datetime import datetime
+from zoneinfo import ZoneInfo
+from rapidfuzz import process, fuzz
+from rapidfuzz.utils import default_process
+from postgrest.exceptions import APIError
 from st_supabase_connection import SupabaseConnection
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # --- 1. INITIALIZE & DB CONNECTION ---
+IST = ZoneInfo("Asia/Kolkata")
+# Calendar date for this script run, shared by every page and loader instead of re-reading the clock
+TODAY_IST = datetime.now(IST).date()
+
 if "last_refresh" not in st.session_state:
     st.session_state["last_refresh"] = "Initializing..."
 
-conn = st.connection("supabase", type=SupabaseConnection)
+# Confirmation from a write on the previous run: write paths rerun straight away instead of
+# sleeping so the message can be read, which would pin this session's script thread
+if msg := st.session_state.pop("flash", None):
+    st.toast(msg, icon="✅")
 
-@st.cache_data(ttl=60)
-def load_supabase_data():
-    try:
-        # Fetching from the LIVE table for the main dashboard
-        response = conn.table("cylinders").select("*").execute()
-        df_raw = pd.DataFrame(response.data)
+@st.cache_resource
+def get_conn():
+    # One connection (and one HTTP keep-alive pool) shared by every rerun and session
+    connection = st.connection("supabase", type=SupabaseConnection)
+    
+    # Swap PostgREST's default httpx client for an HTTP/2 one, so concurrent sessions multiplex
+    # over a small pool that stays well under Supabase's connection cap.
+    # Relies on the private postgrest.session attribute; supabase-py rebuilds the postgrest client
+    # (and so drops this swap, falling back to its default session) when the auth state changes.
+    postgrest = connection.client.postgrest
+    default_session = postgrest.session
+    postgrest.session = httpx.Client(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        follow_redirects=default_session.follow_redirects,
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+        timeout=30,
+    )
+    default_session.close()
+    return connection
+
+@st.cache_resource
+def get_pg():
+    # The supabase client every query and write goes through; reuses the connection's pooled session
+    return get_conn().client
+
+# Per-page projections, so no page pulls columns it doesn't show:
+# the sidebar, dashboard metrics and return selectbox need only SUMMARY_COLS, the finder adds a few more
+SUMMARY_COLS = "Cylinder_ID,Status,Next_Test_Due,Overdue"
+FIND_COLS = SUMMARY_COLS + ",Customer_Name,Location_PIN"
+FULL_COLS = ("Cylinder_ID,Customer_Name,Status,Location_PIN,Capacity_kg,Fill_Percent,"
+             "Last_Fill_Date,Last_Test_Date,Next_Test_Due,Overdue")
+
+# Location PINs are up to 6 digits (matches max_chars=6 and the DB check constraint)
+PIN_RE = re.compile(r"\d{1,6}")
+
+def clean_cylinder_frame(df_raw):
+    # --- TIMEZONE & DATE CLEANING (shared by every loader) ---
+    if not df_raw.empty:
+        # Already-clean columns are left alone, so typed sources don't pay for a second conversion
+        if "Location_PIN" in df_raw.columns:
+            pins = df_raw["Location_PIN"]
+            sample = pins.head(64)
+            if not (pd.api.types.is_string_dtype(pins) and sample.str.len().eq(sample.str.strip().str.len()).all()):
+                df_raw["Location_PIN"] = pins.astype(str).str.strip()
         
-        # --- TIMEZONE & DATE CLEANING ---
-        ist = pytz.timezone('Asia/Kolkata')
-        st.session_state["last_refresh"] = datetime.now(ist).strftime("%I:%M:%S %p")
+        # Arrow-backed strings (already the case for the CSV summary): .str ops run in Arrow kernels
+        for col in ("Cylinder_ID", "Customer_Name", "Location_PIN"):
+            if col in df_raw.columns:
+                df_raw[col] = df_raw[col].astype("string[pyarrow]")
         
-        if not df_raw.empty:
-            if "Location_PIN" in df_raw.columns:
-                df_raw["Location_PIN"] = df_raw["Location_PIN"].astype(str).str.strip()
-            
-            date_cols = ["Last_Fill_Date", "Last_Test_Date", "Next_Test_Due"]
-            for col in date_cols:
-                if col in df_raw.columns:
-                    df_raw[col] = pd.to_datetime(df_raw[col], errors='coerce')
+        date_cols = ["Last_Fill_Date", "Last_Test_Date", "Next_Test_Due"]
+        for col in date_cols:
+            if col in df_raw.columns and not pd.api.types.is_datetime64_any_dtype(df_raw[col]):
+                df_raw[col] = pd.to_datetime(df_raw[col], errors='coerce')
         
-        return df_raw
-    except Exception as e:
-        st.session_state["last_refresh"] = "Refresh Error"
-        st.error(f"Database Connection Error: {e}")
-        return pd.DataFrame()
+        # Low-cardinality text becomes categorical, so equality checks compare small integer codes
+        if "Status" in df_raw.columns:
+            df_raw["Status"] = df_raw["Status"].astype("category")
+        if "Customer_Name" in df_raw.columns and df_raw["Customer_Name"].nunique() < len(df_raw) // 2:
+            df_raw["Customer_Name"] = df_raw["Customer_Name"].astype("category")
+        if "Location_PIN" in df_raw.columns:
+            # A fleet spans a handful of PIN codes
+            df_raw["Location_PIN"] = df_raw["Location_PIN"].astype("category")
+        
+        if "Next_Test_Due" in df_raw.columns:
+            # Overdue against today's IST date: "due before tomorrow", compared in the column's own
+            # datetime64 unit so no truncated copy of the column is allocated (NaT compares False)
+            tomorrow64 = np.datetime64(TODAY_IST, "D") + 1
+            df_raw["Overdue_Today"] = df_raw["Next_Test_Due"].to_numpy() < tomorrow64
+        
+        if "Cylinder_ID" in df_raw.columns:
+            # Uppercased once here, so ID searches don't re-uppercase the column on every rerun
+            df_raw["_Cylinder_ID_upper"] = df_raw["Cylinder_ID"].str.upper()
+            # Indexed by ID (column kept) so exact lookups are hash lookups instead of full scans
+            df_raw.set_index("Cylinder_ID", drop=False, inplace=True)
+            df_raw.index = df_raw.index.astype("string[pyarrow]")
+            df_raw.index.name = None
+    return df_raw
+
+# Stale-while-revalidate windows for the summary (seconds): fresh data is served as-is,
+# stale data is served while a background refresh runs, anything older blocks on the DB
+SUMMARY_FRESH_TTL = 60
+SUMMARY_MAX_AGE = 15 * 60
+
+@st.cache_resource
+def summary_store():
+    # Last-good summary, shared by every session of this worker.
+    # snapshot is (df, total, synced, id_arrays), swapped as one tuple so readers never mix two snapshots;
+    # generation counts local writes, so a refresh that overlapped one knows its rows may be stale
+    return {"snapshot": None, "ts": 0.0, "version": 0, "generation": 0, "refreshing": False, "lock": threading.Lock()}
+
+def build_id_arrays(df_raw):
+    # Return-page selectbox options plus their uppercased copy for substring search,
+    # built once per snapshot so reruns just read them
+    if df_raw.empty:
+        return np.array([], dtype=object), np.array([], dtype="U")
+    # The index doesn't enforce unique IDs, so each duplicated ID is listed once
+    first = ~df_raw.index.duplicated()
+    return df_raw.index.to_numpy(dtype=object)[first], df_raw["_Cylinder_ID_upper"].to_numpy(dtype="U")[first]
+
+def fetch_summary_frame(client):
+    # Fetching a narrow projection from the LIVE table as CSV, parsed straight into Arrow:
+    # typed columns (dates included) without building a Python dict per row first
+    response = client.postgrest.session.get(
+        "/cylinders",
+        # Ordered by Postgres (indexed), so no sort on the pandas side
+        params={"select": SUMMARY_COLS, "order": "Next_Test_Due.asc"},
+        headers={"Accept": "text/csv", "Prefer": "count=exact"},
+    )
+    response.raise_for_status()
+    if not response.content.strip():
+        return pd.DataFrame(), 0
+    
+    # IDs stay text even when a barcode is all digits ("00123" must not load as 123);
+    # Postgres writes booleans as t/f, so Overdue loads as bool like it does from the JSON loaders
+    table = pa_csv.read_csv(io.BytesIO(response.content),
+                            convert_options=pa_csv.ConvertOptions(
+                                strings_can_be_null=True,
+                                column_types={"Cylinder_ID": pa.string(), "Status": pa.string()},
+                                true_values=["t"], false_values=["f"]))
+    df_raw = table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get, date_as_object=False)
+    
+    # The exact count comes back in the same call, as Content-Range: 0-99/100
+    total = response.headers.get("content-range", "").rsplit("/", 1)[-1]
+    return df_raw, int(total) if total.isdigit() else len(df_raw)
+
+# Refetches allowed when local writes keep landing mid-fetch; after that the patched snapshot stays
+REFRESH_ATTEMPTS = 3
+
+def refresh_summary(store, client):
+    # No st.* calls in here: this also runs on a background thread
+    for _ in range(REFRESH_ATTEMPTS):
+        with store["lock"]:
+            generation = store["generation"]
+        df_raw, total = fetch_summary_frame(client)
+        df_raw = clean_cylinder_frame(df_raw)
+        id_arrays = build_id_arrays(df_raw)
+        
+        with store["lock"]:
+            if store["generation"] != generation:
+                # A write was patched in while this fetch ran: its rows may predate it, fetch again
+                continue
+            # The version only moves when the data did, so version-keyed caches survive no-op refreshes
+            previous = store["snapshot"]
+            if previous is None or previous[1] != total or not previous[0].equals(df_raw):
+                store["version"] += 1
+            store["snapshot"] = (df_raw, total, datetime.now(IST).strftime("%I:%M:%S %p"), id_arrays)
+            store["ts"] = time.time()
+            return
+
+def background_refresh(store, client):
+    try:
+        refresh_summary(store, client)
+    finally:
+        store["refreshing"] = False
+
+def revalidate_summary(store):
+    with store["lock"]:
+        start = not store["refreshing"]
+        store["refreshing"] = True
+    if start:
+        threading.Thread(target=background_refresh, args=(store, get_pg()), daemon=True).start()
+
+def patch_summary(patch):
+    # Optimistic write-through: swap in a patched copy of the snapshot so this and other
+    # sessions see the change on their next rerun, before the background refetch lands
+    store = summary_store()
+    with store["lock"]:
+        if store["snapshot"] is None:
+            return
+        # Any refresh already in flight refetches instead of overwriting this patch
+        store["generation"] += 1
+        df_raw, total, synced, _ = store["snapshot"]
+        df_raw, total = patch(df_raw.copy(), total)
+        store["snapshot"] = (df_raw, total, synced, build_id_arrays(df_raw))
+        store["version"] += 1
+
+def load_dashboard_summary():
+    store = summary_store()
+    age = time.time() - store["ts"]
+    
+    failed = False
+    if store["snapshot"] is None or age > SUMMARY_MAX_AGE:
+        try:
+            refresh_summary(store, get_pg())
+        except Exception as e:
+            failed = True
+            st.session_state["last_refresh"] = "Refresh Error"
+            st.error(f"Database Connection Error: {e}")
+            if store["snapshot"] is None:
+                return pd.DataFrame(), 0, build_id_arrays(pd.DataFrame())
+    elif age > SUMMARY_FRESH_TTL:
+        # Paint from the last-good data now, revalidate in the background
+        revalidate_summary(store)
+    
+    df_raw, total, synced, id_arrays = store["snapshot"]
+    if not failed:
+        # On a failed refresh the sidebar keeps showing "Refresh Error" over the stale data
+        st.session_state["last_refresh"] = synced
+    return df_raw, total, id_arrays
+
+# Loaders are keyed on data_version() rather than wall clock; the long TTL and max_entries only bound memory.
+# The version follows the summary columns, so edits made elsewhere to other columns (Customer_Name,
+# Location_PIN, Fill_Percent) show up once the ID/status/due-date data changes, or after CACHE_TTL.
+# Loaders let errors propagate (st.cache_data doesn't cache exceptions) and callers report them,
+# so a failed query is retried on the next run instead of being cached.
+CACHE_TTL = 24 * 60 * 60
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=200)
+def load_full(cylinder_id, version):
+    # Every column the app knows about, for a single cylinder (return page detail)
+    response = get_pg().table("cylinders").select(FULL_COLS).eq("Cylinder_ID", cylinder_id).limit(1).execute()
+    return response.data[0] if response.data else None
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=5)
+def load_fleet_stats(version):
+    # (total, overdue, empty) from the fleet_stats() function in supabase/migrations
+    row = get_pg().rpc("fleet_stats").execute().data[0]
+    return row["total"], row["overdue"], row["empty"]
+
+def data_version():
+    # Bumped whenever the summary changes (refresh or local write); the cache key the loaders take
+    return summary_store()["version"]
+
+def invalidate_caches():
+    # After a write: drop cached searches and revalidate the (already patched) summary in the background
+    st.cache_data.clear()
+    st.session_state.pop("finder_results", None)
+    store = summary_store()
+    if store["snapshot"] is None:
+        store["ts"] = 0.0
+    else:
+        revalidate_summary(store)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=5)
+def load_customer_names(version):
+    # Distinct customer names (deduplicated by Postgres), scored locally by RapidFuzz for typo-tolerant search
+    try:
+        rows = get_pg().rpc("customer_names").execute().data
+    except APIError:
+        # customer_names() not deployed yet: dedupe the full column here instead
+        rows = get_pg().table("cylinders").select("Customer_Name").execute().data
+    return sorted({row["Customer_Name"] for row in rows if row["Customer_Name"]})
+
+# Fuzzy-only name matches added to a search; each one is spelled out in the request URL
+FUZZY_LIMIT = 20
+
+def pgrst_quote(value):
+    # Double-quoted value for a PostgREST or=(...) filter, so commas, dots and brackets in names are literal
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=50)
+def search_cylinders(id_sub, name_sub, status, exact_id, version):
+    # Filters run inside PostgREST, so only the matching rows cross the wire.
+    # Cached as an Arrow table, which st.cache_data (de)serialises much faster than a pickled
+    # DataFrame; call .to_pandas() on the result (dtypes and the ID index round-trip).
+    q = get_pg().table("cylinders").select(FIND_COLS)
+    if id_sub:
+        # A full scanned ID is an indexed equality lookup; partial IDs fall back to a substring match
+        q = q.eq("Cylinder_ID", id_sub) if exact_id else q.ilike("Cylinder_ID", f"%{id_sub}%")
+    if name_sub:
+        # Case-insensitive substring match as before, plus RapidFuzz hits over the name list
+        # so near-miss spellings ("Khan" typed as "Kahn") are found too
+        name_filter = f"Customer_Name.ilike.{pgrst_quote(f'*{name_sub}*')}"
+        # Only names the ilike term doesn't already match go into the URL, and only the best few
+        needle = name_sub.lower()
+        near_misses = [name for name in load_customer_names(version) if needle not in name.lower()]
+        hits = process.extract(name_sub, near_misses, scorer=fuzz.WRatio,
+                               processor=default_process, score_cutoff=75, limit=FUZZY_LIMIT)
+        if hits:
+            name_filter += f",Customer_Name.in.({','.join(pgrst_quote(name) for name, _, _ in hits)})"
+        q = q.or_(name_filter)
+    if status != "All":
+        q = q.eq("Status", status)
+    # Ordered by Postgres (indexed), so results arrive ready to display
+    response = q.order("Next_Test_Due").execute()
+    return pa.Table.from_pandas(clean_cylinder_frame(pd.DataFrame(response.data)))
+
+# Precomputed columns that are used for logic but never displayed
+HELPER_COLS = ["Overdue_Today", "_Cylinder_ID_upper"]
+
+def style_overdue(frame, css):
+    # The precomputed mask builds the whole CSS grid, no Python callback per row.
+    # Positional index for the Styler, which rejects a non-unique one (duplicated IDs); tables hide it anyway
+    view = frame.drop(columns=HELPER_COLS, errors="ignore").reset_index(drop=True)
+    if frame.empty:
+        return view.style
+    # CSS is picked once per row and broadcast across the columns as a view, not copied per cell
+    row_css = np.where(frame["Overdue_Today"].to_numpy(), css, "")
+    css_grid = np.broadcast_to(row_css[:, None], view.shape)
+    return view.style.apply(lambda _: pd.DataFrame(css_grid, index=view.index, columns=view.columns), axis=None)
+
+# Rows per table page (inventory pages, finder "Show more" steps)
+PAGE = 100
+
+def show_paged(frame, css, page_key):
+    # Only the visible rows get styled and serialised to the browser
+    # Frames arrive already sorted by Next_Test_Due from their cached loader
+    shown = PAGE * st.session_state.get(page_key, 1)
+    st.dataframe(style_overdue(frame.head(shown), css), use_container_width=True, hide_index=True)
+    
+    if len(frame) > shown:
+        def show_more():
+            st.session_state[page_key] = st.session_state.get(page_key, 1) + 1
+        st.button(f"Show more ({len(frame) - shown} more)", key=f"{page_key}_more", on_click=show_more)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=50)
+def load_inventory_page(page_num, version):
+    # One page of the inventory, ordered and sliced by Postgres: bytes shipped scale with PAGE, not the fleet
+    offset = (page_num - 1) * PAGE
+    response = get_pg().table("cylinders").select(FIND_COLS).order("Next_Test_Due").range(offset, offset + PAGE - 1).execute()
+    return pa.Table.from_pandas(clean_cylinder_frame(pd.DataFrame(response.data)))
 
 # Load the base data
-df_main = load_supabase_data()
+df_main, fleet_total, id_arrays_main = load_dashboard_summary()
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -52,10 +358,11 @@ st.sidebar.caption(f"Last Sync: {st.session_state['last_refresh']}")
 
 # TEMPORARY: We define 'df' as the full dataset to bypass the Batch_ID KeyError
 # This ensures Dashboard, Finder, and Inventory pages still have data to show.
-df = df_main.copy()
+# No copy: the pages only read from it, so there's no need to duplicate the frame every rerun.
+df = df_main
 
 # Add a simple status message so you know the filter is off
-st.sidebar.info(f"Total Fleet: {len(df)} units")
+st.sidebar.info(f"Total Fleet: {fleet_total} units")
 st.sidebar.warning("Category Filter: Temporarily Disabled")
 
 
@@ -80,33 +387,40 @@ if page == "Dashboard":
     st.title("Live Fleet Dashboard")
     
     if not df.empty:
-        # 1. Setup Dates
-        ist = pytz.timezone('Asia/Kolkata')
-        today = datetime.now(ist).date()
-
-        # 2. Metrics
+        # 1. Metrics (aggregated in Postgres; counted locally only if fleet_stats() isn't deployed)
+        try:
+            stats = load_fleet_stats(data_version())
+        except Exception:
+            stats = None
+        if stats is None:
+            # One pass per column over the backing arrays, no filtered frames materialised
+            status_counts = df["Status"].value_counts()
+            stats = (len(df), int(df["Overdue_Today"].to_numpy().sum()), int(status_counts.get("Empty", 0)))
+        total_units, overdue_count, empty_count = stats
+        
         col1, col2, col3 = st.columns(3)
-        col1.metric("Total Units", len(df))
-        overdue_count = len(df[df["Next_Test_Due"].dt.date <= today])
+        col1.metric("Total Units", total_units)
         col2.metric("Overdue (Test)", overdue_count)
-        col3.metric("Empty Stock", len(df[df["Status"] == "Empty"]))
-
-        # 3. Style Function (Dark Grey / Near Black)
-        def highlight_overdue(row):
-            # Hex #1E1E1E is a soft "Onyx" grey close to black
-            if row["Next_Test_Due"].date() <= today:
-                return ['background-color: #303030; color: white; font-weight: italic'] * len(row)
-            return [''] * len(row)
+        col3.metric("Empty Stock", empty_count)
 
-        styled_df = df.style.apply(highlight_overdue, axis=1)
-
-        st.subheader("Inventory Overview")
-        
-        # 4. Display with Hidden Index
-        st.dataframe(styled_df, use_container_width=True, hide_index=True)
-        
-        # 5. Footer Note
-        st.caption("**Grey Rows indicate cylinders that have exceeded their safety test date.")
+        # 2. Inventory table is only fetched and styled when asked for
+        if st.toggle("Show Inventory Overview"):
+            st.subheader("Inventory Overview")
+            
+            # Server-side pages; only the metrics above use the fully loaded summary
+            last_page = max(1, -(-total_units // PAGE))
+            page_num = st.number_input(f"Page (of {last_page})", min_value=1, max_value=last_page, step=1, key="inventory_page_num")
+            try:
+                inventory_df = load_inventory_page(int(page_num), data_version()).to_pandas()
+            except Exception as e:
+                st.error(f"Inventory Error: {e}")
+            else:
+                # Display with Hidden Index, styled Dark Grey / Near Black
+                styled_df = style_overdue(inventory_df, 'background-color: #303030; color: white; font-style: italic')
+                st.dataframe(styled_df, use_container_width=True, hide_index=True)
+            
+            # Footer Note
+            st.caption("**Grey Rows indicate cylinders that have exceeded their safety test date.")
     else:
         st.warning("No data found.")
         
@@ -116,69 +430,93 @@ if page == "Dashboard":
 elif page == "Cylinder Finder":
     st.title("Advanced Cylinder Search")
 
-    # 1. DEFINE THE CALLBACK
-    def clear_callback():
-        st.session_state["s_id_key"] = ""
-        st.session_state["s_name_key"] = ""
-
-    # 2. Initialize keys safely
-    if "s_id_key" not in st.session_state:
-        st.session_state["s_id_key"] = ""
-    if "s_name_key" not in st.session_state:
-        st.session_state["s_name_key"] = ""
-
-    # 3. Search Inputs with Vertical Alignment
-    colA, colB, colC, colD = st.columns([3, 3, 2, 1], vertical_alignment="bottom")
-    
-    with colA:
-        s_id = st.text_input("Search ID (Scan Now)", key="s_id_key").strip().upper()
-    with colB:
-        s_name = st.text_input("Search Customer", key="s_name_key").strip()
-    with colC:
-        s_status = st.selectbox("Filter Status", ["All", "Full", "Empty", "Damaged"])
-    with colD:
-        # The button will now sit perfectly level with the input fields
-        st.button("Reset", on_click=clear_callback, use_container_width=True)
-
-    # 4. Date Setup
-    ist = pytz.timezone('Asia/Kolkata')
-    today = datetime.now(ist).date()
-
-    # 5. Filtering Logic
-    f_df = df.copy()
-    if s_id:
-        f_df = f_df[f_df["Cylinder_ID"].str.upper().str.contains(s_id, na=False)]
-    if s_name:
-        f_df = f_df[f_df["Customer_Name"].str.contains(s_name, case=False, na=False)]
-    if s_status != "All":
-        f_df = f_df[f_df["Status"] == s_status]
-
-    # 6. Alert Logic (Only for ID or Name search)
-    if s_id or s_name:
-        if not f_df.empty:
-            overdue_list = f_df[f_df["Next_Test_Due"].dt.date <= today]
-            num_overdue = len(overdue_list)
-            if num_overdue > 0:
-                if s_id and num_overdue == 1:
-                    due_date = overdue_list.iloc[0]["Next_Test_Due"].date()
-                    st.error(f"⚠️ SAFETY ALERT: Cylinder {s_id} is OVERDUE! (Due: {due_date})")
+    # Fragment: searches and paging rerun only this page body, not the whole script
+    @st.fragment
+    def cylinder_finder(df):
+        # 1. DEFINE THE CALLBACKS
+        # The search only runs when a query is submitted; its results are kept until the next one
+        def apply_search():
+            st.session_state["finder_query"] = (
+                st.session_state["s_id_key"].strip().upper(),
+                st.session_state["s_name_key"].strip(),
+                st.session_state["s_status_key"],
+            )
+            st.session_state["finder_page"] = 1
+            st.session_state.pop("finder_results", None)
+
+        def clear_callback():
+            st.session_state["s_id_key"] = ""
+            st.session_state["s_name_key"] = ""
+            st.session_state["s_status_key"] = "All"
+            st.session_state["finder_query"] = ("", "", "All")
+            st.session_state["finder_page"] = 1
+            st.session_state.pop("finder_results", None)
+
+        # 2. Initialize keys safely
+        if "s_id_key" not in st.session_state:
+            st.session_state["s_id_key"] = ""
+        if "s_name_key" not in st.session_state:
+            st.session_state["s_name_key"] = ""
+        if "finder_query" not in st.session_state:
+            st.session_state["finder_query"] = ("", "", "All")
+
+        # 3. Search Inputs with Vertical Alignment, inside a form so typing never reruns the page.
+        # Enter (what scanners send after the ID) submits through the first button, Search.
+        with st.form("finder", clear_on_submit=False):
+            colA, colB, colC, colD, colE = st.columns([3, 3, 2, 1, 1], vertical_alignment="bottom")
+        
+            with colA:
+                st.text_input("Search ID (Scan Now)", key="s_id_key")
+            with colB:
+                st.text_input("Search Customer", key="s_name_key")
+            with colC:
+                st.selectbox("Filter Status", ["All", "Full", "Empty", "Damaged"], key="s_status_key")
+            with colD:
+                # The buttons will now sit perfectly level with the input fields
+                st.form_submit_button("Search", on_click=apply_search, use_container_width=True, type="primary")
+            with colE:
+                st.form_submit_button("Reset", on_click=clear_callback, use_container_width=True)
+
+        s_id, s_name, s_status = st.session_state["finder_query"]
+
+        # 4. Filtering Logic (runs server-side, see search_cylinders), once per submitted query
+        # and again whenever the data version moves (other sessions' writes, refreshes); cached, so cheap
+        version = data_version()
+        results = st.session_state.get("finder_results")
+        if results is None or results[0] != version:
+            exact_id = bool(s_id) and s_id in df.index
+            try:
+                results = (version, search_cylinders(s_id, s_name, s_status, exact_id, version).to_pandas())
+            except Exception as e:
+                # Nothing stored, so the next run retries the query
+                st.error(f"Search Error: {e}")
+                return
+            st.session_state["finder_results"] = results
+        f_df = results[1]
+
+        # 5. Alert Logic (Only for ID or Name search)
+        if s_id or s_name:
+            if not f_df.empty:
+                # Count off the boolean mask; no overdue sub-frame is materialised
+                overdue_mask = f_df["Overdue_Today"].to_numpy(dtype=bool, na_value=False)
+                num_overdue = int(overdue_mask.sum())
+                if num_overdue > 0:
+                    if s_id and num_overdue == 1:
+                        due_date = f_df["Next_Test_Due"].to_numpy()[overdue_mask.argmax()].astype("datetime64[D]")
+                        st.error(f"⚠️ SAFETY ALERT: Cylinder {s_id} is OVERDUE! (Due: {due_date})")
+                    else:
+                        st.error(f"⚠️ ATTENTION: Found {num_overdue} overdue cylinder(s) for your search.")
                 else:
-                    st.error(f"⚠️ ATTENTION: Found {num_overdue} overdue cylinder(s) for your search.")
+                    st.success(f"✅ No overdue cylinders found for this search.")
             else:
-                st.success(f"✅ No overdue cylinders found for this search.")
-        else:
-            st.warning("No matching cylinders found.")
+                st.warning("No matching cylinders found.")
 
-    # 7. Apply Dark-Grey Styling
-    def highlight_overdue(row):
-        if row["Next_Test_Due"].date() <= today:
-            return ['background-color: #1E1E1E; color: #E0E0E0; font-weight: bold'] * len(row)
-        return [''] * len(row)
+        # 6. Apply Dark-Grey Styling
+        # Hex #1E1E1E is a soft "Onyx" grey close to black
+        st.subheader(f"Results Found: {len(f_df)}")
+        show_paged(f_df, 'background-color: #1E1E1E; color: #E0E0E0; font-weight: bold', "finder_page")
 
-    styled_f_df = f_df.style.apply(highlight_overdue, axis=1)
-
-    st.subheader(f"Results Found: {len(f_df)}")
-    st.dataframe(styled_f_df, use_container_width=True, hide_index=True)
+    cylinder_finder(df)
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -209,7 +547,8 @@ elif page == "Bulk Operations":
         
         batch_data = pd.DataFrame()
         if batch_lookup:
-            res = conn.table(TARGET_TABLE).select("*").eq("Batch_ID", batch_lookup).execute()
+            # Only the columns the reconciliation below uses
+            res = get_pg().table(TARGET_TABLE).select("Cylinder_ID,Status,Current_Location").eq("Batch_ID", batch_lookup).execute()
             batch_data = pd.DataFrame(res.data)
             
             if not batch_data.empty:
@@ -259,7 +598,7 @@ elif page == "Bulk Operations":
                         payload["Customer_Name"] = new_owner
 
                     try:
-                        conn.table(TARGET_TABLE).update(payload).in_("Cylinder_ID", id_list).execute()
+                        get_pg().table(TARGET_TABLE).update(payload).in_("Cylinder_ID", id_list).execute()
                         st.success(f"✅ Successfully updated {len(id_list)} cylinders!")
                         st.balloons()
                         st.cache_data.clear() # Refresh progress bar data
@@ -286,22 +625,24 @@ elif page == "Bulk Operations":
         st.subheader("🚩 Batch Reconciliation Status")
         
         total = len(batch_data)
-        completed = len(batch_data[batch_data["Status"] == "Full"])
+        # One pass over Status serves every metric below
+        status_counts = batch_data["Status"].value_counts()
+        completed = int(status_counts.get("Full", 0))
         prog = completed / total
         
         st.write(f"**Overall Progress:** {completed} of {total} units ({(prog*100):.1f}%)")
         st.progress(prog)
 
         # Breakdown Metrics
-        remaining_df = batch_data[batch_data["Status"] != "Full"]
         m1, m2, m3 = st.columns(3)
         m1.metric("Processed (Full)", completed)
-        m2.metric("In Testing (Empty)", len(remaining_df[remaining_df["Status"] == "Empty"]))
-        m3.metric("Damaged/Rejected", len(remaining_df[remaining_df["Status"] == "Damaged"]))
+        m2.metric("In Testing (Empty)", int(status_counts.get("Empty", 0)))
+        m3.metric("Damaged/Rejected", int(status_counts.get("Damaged", 0)))
         
-        if not remaining_df.empty:
-            with st.expander(f"View IDs of the {len(remaining_df)} Pending Units"):
-                st.dataframe(remaining_df[["Cylinder_ID", "Status", "Current_Location"]], 
+        if completed < total:
+            with st.expander(f"View IDs of the {total - completed} Pending Units"):
+                pending = batch_data.loc[batch_data["Status"].to_numpy() != "Full", ["Cylinder_ID", "Status", "Current_Location"]]
+                st.dataframe(pending, 
                              use_container_width=True, hide_index=True)
         else:
             st.success("Batch Reconciliation Complete: All cylinders accounted for.")
@@ -311,76 +652,212 @@ elif page == "Bulk Operations":
 # 5. RETURN & PENALTY LOG
 elif page == "Return & Penalty Log":
     st.title("Cylinder Return Audit")
-    if not df.empty:
-        # You can also scan into a selectbox if the ID matches exactly
-        target_id = st.selectbox("Select ID for Return", options=df["Cylinder_ID"].unique())
-        with st.form("audit_form"):
-            condition = st.selectbox("Condition", ["Good", "Dented", "Leaking", "Valve Damage"])
-            if st.form_submit_button("Submit Return"):
-                new_status = "Empty" if condition == "Good" else "Damaged"
+
+    # Fragment: filtering and selecting IDs rerun only this page body; saving still reruns the whole app
+    @st.fragment
+    def return_page(df, id_arrays):
+        if not df.empty:
+            # Scan or type part of an ID to narrow the list (one vectorised substring pass over the cached IDs)
+            id_filter = st.text_input("Filter IDs (Scan or Type)").strip().upper()
+            options, upper_ids = id_arrays
+            if id_filter:
+                options = options[np.char.find(upper_ids, id_filter) >= 0]
+        
+            if len(options) == 0:
+                st.warning("No matching cylinders found.")
+            else:
+                # You can also scan into a selectbox if the ID matches exactly
+                target_id = st.selectbox("Select ID for Return", options=options)
+        
+                # Hash lookup on the ID index, not a scan of the whole fleet
+                # (list lookup + first row, so a duplicated ID still yields a single row)
+                current = df.loc[[target_id]].iloc[0]
+                due = current["Next_Test_Due"]
+                st.caption(f"Current Status: {current['Status']} | Next Test Due: {due.date() if pd.notna(due) else 'Unknown'}")
                 try:
-                    conn.table("cylinders").update({"Status": new_status, "Fill_Percent": 0}).eq("Cylinder_ID", target_id).execute()
-                    st.success(f"Cylinder {target_id} processed!")
-                    time.sleep(2)
-                    st.cache_data.clear()
-                    st.rerun()
+                    details = load_full(target_id, data_version())
                 except Exception as e:
-                    st.error(f"Update failed: {e}")
+                    details = None
+                    st.error(f"Detail Error: {e}")
+                if details:
+                    st.caption(f"Customer: {details.get('Customer_Name')} | Fill: {details.get('Fill_Percent')}% | PIN: {details.get('Location_PIN')}")
+                if current["Overdue_Today"]:
+                    st.warning(f"⚠️ Cylinder {target_id} is overdue for its safety test.")
+                with st.form("audit_form"):
+                    condition = st.selectbox("Condition", ["Good", "Dented", "Leaking", "Valve Damage"])
+                    if st.form_submit_button("Submit Return"):
+                        new_status = "Empty" if condition == "Good" else "Damaged"
+                        try:
+                            get_pg().table("cylinders").update({"Status": new_status, "Fill_Percent": 0}).eq("Cylinder_ID", target_id).execute()
+                        
+                            def set_status(frame, total):
+                                # A refresh may have swapped in a snapshot without this ID; .loc would add a phantom row
+                                if target_id not in frame.index:
+                                    return frame, total
+                                if isinstance(frame["Status"].dtype, pd.CategoricalDtype) and new_status not in frame["Status"].cat.categories:
+                                    frame["Status"] = frame["Status"].cat.add_categories([new_status])
+                                frame.loc[target_id, "Status"] = new_status
+                                return frame, total
+                        
+                            patch_summary(set_status)
+                            invalidate_caches()
+                            st.session_state["flash"] = f"Cylinder {target_id} processed!"
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Update failed: {e}")
+
+    # The ID arrays are handed over with df (both from one snapshot) so fragment reruns keep using it
+    return_page(df, id_arrays_main)
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # 6. ADD NEW CYLINDER (Hardware Scanner Friendly)
 elif page == "Add New Cylinder":
     st.title("Register New Cylinder")
+
+    # Fragment: scans and batch edits rerun only this page body, not the sidebar/summary load
+    @st.fragment
+    def add_cylinder_page(df):
+        # Scans are queued here and written with a single insert when the batch is flushed
+        if "pending_inserts" not in st.session_state:
+            st.session_state["pending_inserts"] = []
+        if "upload_nonce" not in st.session_state:
+            st.session_state["upload_nonce"] = 0
+        pending = st.session_state["pending_inserts"]
+
+        # Next_Test_Due and Overdue are filled in by Postgres (insert trigger / default)
+        def build_payload(c_id, cust, pin, cap_val):
+            return {
+                "Cylinder_ID": str(c_id),
+                "Customer_Name": str(cust),
+                "Location_PIN": int(pin) if PIN_RE.fullmatch(pin) else 0,
+                "Capacity_kg": float(cap_val),
+                "Fill_Percent": 100,
+                "Status": "Full",
+                "Last_Fill_Date": str(TODAY_IST),
+                "Last_Test_Date": str(TODAY_IST)
+            }
+
+        def insert_batch(rows):
+            # PostgREST takes an array body, so N cylinders cost one round trip
+            try:
+                get_pg().table("cylinders").insert(rows).execute()
+            
+                def append_rows(frame, total):
+                    new_rows = pd.DataFrame(rows)
+                    # Mirror the database-side defaults until the background refetch replaces these rows
+                    new_rows["Next_Test_Due"] = pd.to_datetime(new_rows["Last_Test_Date"]) + pd.Timedelta(days=1825)
+                    new_rows["Overdue"] = False
+                    new_rows = clean_cylinder_frame(new_rows[SUMMARY_COLS.split(",")])
+                    combined = pd.concat([frame, new_rows]).sort_values("Next_Test_Due")
+                    # concat falls back to plain objects when the two Status categoricals differ; re-cast it
+                    combined["Status"] = combined["Status"].astype("category")
+                    return combined, total + len(rows)
+            
+                patch_summary(append_rows)
+                invalidate_caches()
+                st.session_state["flash"] = f"{len(rows)} cylinder(s) added successfully!"
+                return True
+            except APIError as e:
+                # The unique index on Cylinder_ID does the duplicate check, no pre-query needed
+                if e.code == "23505":
+                    st.error(f"Cylinder ID already registered: {e.details}")
+                else:
+                    st.error(f"Database Error: {e}")
+                return False
+            except Exception as e:
+                st.error(f"Database Error: {e}")
+                return False
     
-    # clear_on_submit=True is critical for scanners so you don't have to delete the old ID manually
-    with st.form("new_entry_form", clear_on_submit=True):
-        st.write("Scan the cylinder barcode to auto-fill ID.")
-        c_id = st.text_input("New Cylinder ID").strip().upper()
+        # clear_on_submit=True is critical for scanners so you don't have to delete the old ID manually
+        with st.form("new_entry_form", clear_on_submit=True):
+            st.write("Scan the cylinder barcode to auto-fill ID.")
+            c_id = st.text_input("New Cylinder ID").strip().upper()
         
-        cust = st.text_input("Customer Name", value="Internal Stock")
-        pin = st.text_input("Location PIN", value="500001", max_chars=6)
+            cust = st.text_input("Customer Name", value="Internal Stock")
+            pin = st.text_input("Location PIN", value="500001", max_chars=6)
         
-        cap_val = st.selectbox("Capacity (kg)", options=[5.0, 10.0, 14.2, 19.0, 47.5], index=2)
+            cap_val = st.selectbox("Capacity (kg)", options=[5.0, 10.0, 14.2, 19.0, 47.5], index=2)
         
-        if st.form_submit_button("Add Cylinder"):
-            if not c_id:
-                st.error("Missing Cylinder ID!")
-            else:
-                today = datetime.now().date()
-                payload = {
-                    "Cylinder_ID": str(c_id),
-                    "Customer_Name": str(cust),
-                    "Location_PIN": int(pin) if pin.isdigit() else 0,
-                    "Capacity_kg": float(cap_val),
-                    "Fill_Percent": 100,
-                    "Status": "Full",
-                    "Last_Fill_Date": str(today),
-                    "Last_Test_Date": str(today),
-                    "Next_Test_Due": str(today + pd.Timedelta(days=1825)),
-                    "Overdue": False
-                }
-                try:
-                    conn.table("cylinders").insert(payload).execute()
-                    st.success(f"Cylinder {c_id} added successfully!")
-                    time.sleep(2)
-                    st.cache_data.clear()
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Database Error: {e}")
+            if st.form_submit_button("Add to Batch"):
+                if not c_id:
+                    st.error("Missing Cylinder ID!")
+                elif any(row["Cylinder_ID"] == c_id for row in pending):
+                    st.warning(f"Cylinder {c_id} is already in this batch.")
+                elif c_id in df.index:
+                    # Early hint from the loaded summary; the database still has the final say
+                    st.warning(f"Cylinder {c_id} is already registered.")
+                else:
+                    pending.append(build_payload(c_id, cust, pin, cap_val))
+                    st.success(f"Cylinder {c_id} queued.")
+
+        # Pending batch
+        if pending:
+            st.subheader(f"Pending Batch: {len(pending)} cylinder(s)")
+            # Fixed height keeps a truckload of scans scrollable instead of pushing the buttons off screen
+            st.dataframe(pd.DataFrame(pending)[["Cylinder_ID", "Customer_Name", "Location_PIN", "Capacity_kg"]],
+                         use_container_width=True, hide_index=True, height=250)
+        
+            # Mis-scans can be dropped before anything is written
+            col_pick, col_remove = st.columns([3, 1], vertical_alignment="bottom")
+            with col_pick:
+                drop_ids = st.multiselect("Remove from Batch", [row["Cylinder_ID"] for row in pending])
+            with col_remove:
+                if st.button("Remove Selected", use_container_width=True, disabled=not drop_ids):
+                    st.session_state["pending_inserts"] = [row for row in pending if row["Cylinder_ID"] not in drop_ids]
+                    st.rerun(scope="fragment")
+        
+            col_flush, col_discard = st.columns([3, 1])
+            with col_flush:
+                if st.button(f"Save Batch ({len(pending)})", type="primary", use_container_width=True):
+                    if insert_batch(pending):
+                        st.session_state["pending_inserts"] = []
+                        st.rerun()
+            with col_discard:
+                if st.button("Discard Batch", use_container_width=True):
+                    st.session_state["pending_inserts"] = []
+                    st.rerun(scope="fragment")
+
+        # Bulk upload: the whole file goes in one insert as well
+        with st.expander("Bulk Upload (CSV)"):
+            upload = st.file_uploader("CSV with a Cylinder_ID column (Customer_Name, Location_PIN, Capacity_kg optional)", type="csv",
+                                      key=f"bulk_upload_{st.session_state['upload_nonce']}")
+            if upload is not None:
+                up_df = pd.read_csv(upload, dtype=str).fillna("")
+                if "Cylinder_ID" not in up_df.columns:
+                    st.error("The file needs a Cylinder_ID column.")
+                else:
+                    try:
+                        rows = [
+                            build_payload(
+                                r["Cylinder_ID"].strip().upper(),
+                                r.get("Customer_Name", "").strip() or "Internal Stock",
+                                r.get("Location_PIN", "").strip(),
+                                r.get("Capacity_kg", "").strip() or 14.2,
+                            )
+                            for r in up_df.to_dict("records") if r["Cylinder_ID"].strip()
+                        ]
+                    except ValueError as e:
+                        rows = []
+                        st.error(f"Invalid value in file: {e}")
+                
+                    if rows:
+                        st.write(f"{len(rows)} cylinder(s) ready to upload.")
+                        if st.button("Upload All", type="primary"):
+                            if insert_batch(rows):
+                                # New uploader key so the same file can't be submitted twice
+                                st.session_state["upload_nonce"] += 1
+                                st.rerun()
+
+    add_cylinder_page(df)
                     
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # 7. FOOTER #JCNaga
+# Native captions instead of an unsafe-HTML block: nothing to sanitise on each rerun
+FOOTER_STATIC = "**Developed for** KWS Pvt Ltd • Cylinder Management System v1.2"
 st.markdown("---")
-last_time = st.session_state["last_refresh"]
-footer_text = f"""
-<div style="text-align: center; color: grey; font-size: 0.85em; font-family: sans-serif;">
-    <p><b> Developed for </b> KWS Pvt Ltd </p>
-    <p style="color: #007bff;"><b>Last Refresh:</b> {last_time} IST</p>
-    <p> Cylinder Management System v1.2</p>
-</div>
-"""
-st.markdown(footer_text, unsafe_allow_html=True)
+st.caption(FOOTER_STATIC)
+st.caption(f"**Last Refresh:** {st.session_state['last_refresh']} IST")
 
 
 
@@ -0,0 +1,13 @@
+-- Dashboard metrics in one round trip: called from lgas1.py as rpc("fleet_stats")
+-- "Overdue" uses the IST calendar date, matching the app's own overdue highlighting.
+create or replace function fleet_stats()
+returns table(total int, overdue int, empty int)
+language sql
+stable
+as $$
+    select
+        count(*)::int,
+        (count(*) filter (where "Next_Test_Due" <= (now() at time zone 'Asia/Kolkata')::date))::int,
+        (count(*) filter (where "Status" = 'Empty'))::int
+    from cylinders
+$$;
@@ -0,0 +1,3 @@
+-- Duplicate Cylinder_IDs are rejected by Postgres itself (SQLSTATE 23505), so the
+-- Add New Cylinder page can insert without a "does this ID exist?" round trip first.
+create unique index if not exists cylinders_cylinder_id_key on cylinders ("Cylinder_ID");
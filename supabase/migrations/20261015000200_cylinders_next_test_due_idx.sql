@@ -0,0 +1,2 @@
+-- Backs the Next_Test_Due ordering the app asks PostgREST for, and the overdue count in fleet_stats().
+create index if not exists cylinders_next_test_due_idx on cylinders ("Next_Test_Due");
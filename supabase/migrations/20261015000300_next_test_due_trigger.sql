@@ -0,0 +1,23 @@
+-- Next_Test_Due is derived from Last_Test_Date (5-year retest interval), so inserts no longer send it.
+-- Filled by a trigger rather than a generated column: existing rows keep their stored due dates
+-- (the seed data and any manually extended dates), and only inserts that leave it null are computed.
+create or replace function set_next_test_due()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new."Next_Test_Due" is null then
+        new."Next_Test_Due" := new."Last_Test_Date" + 1825;
+    end if;
+    return new;
+end
+$$;
+
+drop trigger if exists cylinders_set_next_test_due on cylinders;
+create trigger cylinders_set_next_test_due
+    before insert on cylinders
+    for each row execute function set_next_test_due();
+
+-- Overdue can't be a stored generated column (CURRENT_DATE isn't immutable); it simply defaults to
+-- false, and the app works out overdue-ness against today's date itself.
+alter table cylinders alter column "Overdue" set default false;
@@ -0,0 +1,4 @@
+-- Location_PIN is a 6-digit Indian postal code; the Add page already coerces bad input to 0,
+-- this keeps anything else writing to the table (bulk imports, SQL editor) inside the same range.
+alter table cylinders add constraint cylinders_location_pin_check
+    check ("Location_PIN" between 0 and 999999);
@@ -0,0 +1,11 @@
+-- Distinct customer names for the finder's fuzzy search: called from lgas1.py as rpc("customer_names"),
+-- so the app downloads each name once instead of the Customer_Name of every cylinder.
+create or replace function customer_names()
+returns table("Customer_Name" text)
+language sql
+stable
+as $$
+    select distinct "Customer_Name"
+    from cylinders
+    where "Customer_Name" is not null
+$$;